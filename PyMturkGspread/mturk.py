@@ -1,10 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 import numpy as np
 import boto
 from boto.mturk.connection import *
 from oauth2client.service_account import ServiceAccountCredentials
-from scipy import stats
-import matplotlib as mpl
 
 from apiclient.discovery import build
 from httplib2 import Http
@@ -42,8 +42,80 @@ class Survey(object):
 
     To call self.send_second_mailer, please use one of the appropriate
     subclasses.
+
+    MTurk and survey results are cached on the instance after they are first
+    pulled, so repeated calls within one session don't re-fetch them; changing
+    HITlist, questions or the conditions is picked up automatically. Call
+    self.refresh to pull fresh results, e.g. when returning to the same
+    instance after workers have had time to respond. self.award_bonus always
+    refreshes before paying out.
     """
 
+    # MTurk caps get_assignments at 100 results per page
+    PAGE_SIZE = 100
+    # number of assignment pages requested concurrently per wave
+    MAX_PAGE_WORKERS = 8
+    # number of worker notifications sent concurrently
+    MAX_NOTIFY_WORKERS = 16
+
+    # mailer bodies; the reward code (WorkerID) is appended per user
+    _FIRST_MAILER = """Hello,
+
+        Based on your responses to the screening question,
+        you've been selected to participate in the second
+        part of the survey.
+
+        Please go to {srvy_link} to complete additional
+        questions. At the end of the survey, you will be prompted
+        to enter a payment code to verify that you were selected
+        to fill out the survey. When asked, please enter the code
+        below. Upon completion, you will be awarded a bonus.
+
+        Thanks for your participation!
+
+        Sincerely,
+        {from_name}
+
+        ### Your reward code is: """
+
+    _SECOND_MAILER = """Hello,
+
+        We sent you an email recently about completing additional
+        questions for the Mturk Survey. We'd really appreciate
+        your time in helping us improve our products further.
+
+        As a reminder, please go to {srvy_link} to complete
+        additional questions. At the end of the Survey, you will
+        be prompted to enter a payment code to verify that you were
+        selected to fill out the survey. When asked, please enter the
+        code below. Upon completion, you will be awarded a bonus.
+
+        NOTE: If you are receiving this email, but have already completed
+        the Survey, you may have entered the Survey code incorrectly.
+        Please redo the survey, ensuring that the code matches the above,
+        to receive your compensation.
+
+        Thanks for your participation!
+
+        Sincerely,
+        {from_name}
+
+        ### Your reward code is: """
+
+    # each operator maps (df, column, value) to a boolean mask over df
+    _COND_MAPPING = {
+        '==': lambda x, y, z: x[y].values == z,
+        '!=': lambda x, y, z: x[y].values != z,
+        '>=': lambda x, y, z: x[y].values >= z,
+        '<=': lambda x, y, z: x[y].values <= z,
+        # 'isin': lambda x, y, z: x[y].isin(z).values,
+        # 'not isin': lambda x, y, z: ~x[y].isin(z).values,
+        'contains': lambda x, y, z: x[y].str.contains(
+            z, regex=False, na=False).values,
+        'does not contain': lambda x, y, z: ~x[y].str.contains(
+            z, regex=False, na=False).values
+    }
+
     def __init__(self, access_key, secret_access_key, HITlist,
                  questions, srvy_link, from_name):
         """
@@ -63,6 +135,13 @@ class Survey(object):
         self.questions = questions
         self.srvy_link = srvy_link
         self.from_name = from_name
+        self.conditions = ()
+        self._parsed_conditions = []
+
+        # inputs the cached MTurk / survey results were pulled with, or None
+        # if nothing is cached; see refresh()
+        self._mturk_filtered_key = None
+        self._results_key = None
 
         try:
             bal = self.mturk.get_account_balance()[0]
@@ -79,83 +158,146 @@ class Survey(object):
         :param conditions: List of conditions expressed in string form. Should be
                            expressed as follows: 'Login != None'
 
+                           The operator must have a single space on each
+                           side; everything after the space following it is
+                           taken verbatim as the value, so surrounding
+                           whitespace is kept. E.g. 'Name contains  John'
+                           (two spaces) matches the substring ' John'.
+
+                           Conditions may also be given as dicts, e.g.
+                           {'variable': 'Login', 'operator': '!=',
+                            'value': 'None'}
+
                            Permitted operands are:
                            ==, !=, >=, <=, contains, does not contain
         """
-        self.cond_mapping = {
-            '==': lambda x, y, z: x[x[y] == z],
-            '!=': lambda x, y, z: x[x[y] != z],
-            '>=': lambda x, y, z: x[x[y] >= z],
-            '<=': lambda x, y, z: x[x[y] <= z],
-            # 'isin': lambda x, y, z: x[x[y].isin(z)],
-            # 'not isin': lambda x, y, z: x[~x[y].isin(z)],
-            'contains': lambda x, y, z: x[x[y].str.contains(z)],
-            'does not contain': lambda x, y, z: x[~x[y].str.contains(z)]
-        }
+        columns = ['HITID', 'WorkerID', 'AssignmentID'] + list(self.questions)
 
+        parsed_conditions = []
         for cond in conditions:
-            if not any(f == cond['operator'] for f in self.cond_mapping):
-                raise ValueError(cond['operator'] + ' not permitted.')
+            variable, operator, value = self._parse_condition(cond)
+
+            if variable not in columns:
+                raise ValueError(str(variable) + ' is not a screener question.')
+
+            parsed_conditions.append((variable, operator, value,
+                                      self._COND_MAPPING[operator]))
 
         self.conditions = conditions
+        self._parsed_conditions = parsed_conditions
 
+        # the filtered users depend on the conditions, so re-pull on next use
+        self.refresh()
 
-    def get_mturk_results(self, hit_id, questionList):
+    @classmethod
+    def _parse_condition(cls, cond):
         """
-        Return the full results of a HIT.
+        Split a condition into its (variable, operator, value) parts.
+
+        :param cond: condition string such as 'Login != None', or a dict with
+                     'variable', 'operator' and 'value' keys
+        :return: (variable, operator, value) tuple
+        """
+        if isinstance(cond, dict):
+            try:
+                variable, operator, value = (cond['variable'],
+                                             cond['operator'],
+                                             cond['value'])
+            except KeyError as e:
+                raise ValueError('Condition is missing a key!', e)
+
+            if operator not in cls._COND_MAPPING:
+                raise ValueError(str(operator) + ' not permitted.')
+
+            return variable, operator, value
+
+        # try longer operators first so e.g. 'does not contain' wins
+        for operator in sorted(cls._COND_MAPPING, key=len, reverse=True):
+            token = ' %s ' % operator
+            if token in cond:
+                variable, value = cond.split(token, 1)
+                return variable.strip(), operator, value
+
+        raise ValueError(cond + ' does not use a permitted operator.')
+
+    def refresh(self):
+        """
+        Discard the cached MTurk and survey results.
+
+        The next call that needs them (e.g. self.filter_mturk_results or
+        self.get_results) will fetch them again.
+        """
+        self._mturk_filtered_key = None
+        self._results_key = None
+
+    def get_assignments(self, hit_id):
+        """
+        Fetch every assignment submitted for a HIT.
+
+        The first page is requested on its own; if it is full, the remaining
+        pages are requested concurrently in waves of self.MAX_PAGE_WORKERS
+        until a page comes back short.
 
         :param hit_id: MTurk's HIT ID for the task
-        :param questionList: List of questions asked
-        :return: pandas array with HIT ID, Worker ID, Assignment ID,
-                 and responses to all the questions
+        :return: list of boto Assignment objects
         """
-        def helper(hit_id, question):
-            """Helper function, runs for each response and returns a panda."""
-            result, assignments = [], []
+        def fetch(page_number):
+            return self.mturk.get_assignments(hit_id,
+                                              page_size=self.PAGE_SIZE,
+                                              page_number=page_number)
 
-            i = 1
-            while True:
-                assignments_subset = self.mturk.get_assignments(hit_id,
-                                                                page_size=100,
-                                                                page_number=i)
+        assignments = list(fetch(1))
+        if len(assignments) < self.PAGE_SIZE:
+            return assignments
 
-                if len(assignments_subset) > 0:
+        page_number = 2
+        with ThreadPoolExecutor(max_workers=self.MAX_PAGE_WORKERS) as executor:
+            while True:
+                pages = list(executor.map(
+                    fetch,
+                    range(page_number, page_number + self.MAX_PAGE_WORKERS)))
+                for assignments_subset in pages:
                     assignments += assignments_subset
-                    i += 1
-                else:
+
+                if any(len(page) < self.PAGE_SIZE for page in pages):
                     break
+                page_number += self.MAX_PAGE_WORKERS
 
-            for assignment in assignments:
-                question_form_answers = assignment.answers[0]
-                for question_form_answer in question_form_answers:
-                    if question_form_answer.qid == question:
-                        user_response = question_form_answer.fields[0]
-                        result.append([hit_id,
-                                       assignment.WorkerId,
-                                       assignment.AssignmentId,
-                                       user_response])
+        return assignments
 
-            panda = pd.DataFrame(result, columns=['HITID', 'WorkerID',
-                                                  'AssignmentID', question])
+    def get_mturk_results(self, hit_id, questionList):
+        """
+        Return the full results of a HIT.
 
-            return panda
+        Only assignments that answered every question in questionList are
+        kept.
 
-        allPandas = []
-        for question in questionList:
-            df = helper(hit_id, question)
-            allPandas.append(df)
+        :param hit_id: MTurk's HIT ID for the task
+        :param questionList: List of questions asked
+        :return: pandas array with HIT ID, Worker ID, Assignment ID,
+                 and responses to all the questions
+        """
+        questionSet = set(questionList)
 
-        try:
-            mergedPanda = allPandas[0]
-            for panda in allPandas[1:]:
-                mergedPanda = pd.merge(mergedPanda, panda,
-                                       on=['HITID', 'WorkerID',
-                                           'AssignmentID'])
-        except ValueError:
+        result = []
+        for assignment in self.get_assignments(hit_id):
+            answers = {}
+            for question_form_answer in assignment.answers[0]:
+                if question_form_answer.qid in questionSet:
+                    answers[question_form_answer.qid] = question_form_answer.fields[0]
+
+            # keep only assignments that answered every question
+            if len(answers) == len(questionSet):
+                row = [hit_id, assignment.WorkerId, assignment.AssignmentId]
+                row += [answers[question] for question in questionList]
+                result.append(row)
+
+        if not result:
             print('There are no values!')
-            return None
 
-        self.mturk_resp = mergedPanda
+        self.mturk_resp = pd.DataFrame(
+            result,
+            columns=['HITID', 'WorkerID', 'AssignmentID'] + list(questionList))
         return self.mturk_resp
 
     def filter_mturk_results(self):
@@ -164,51 +306,56 @@ class Survey(object):
 
         Df should have results according to screening conditions. See
         self.add_conditions for permitted condition syntax.
-        """
-        def recurse(List):
-            """Recursively find the intersection of all conditions."""
-            if len(List) == 1:
-                return List[0]
-
-            x, y = List[0], List[1]
-            z = x[x.index.isin(y.index)]
-            newList = [z] + List[2:]
 
-            return recurse(newList)
+        Results are cached until HITlist or questions change; use
+        self.refresh to re-pull them from MTurk.
+        """
+        key = (tuple(self.HITlist), tuple(self.questions))
+        if self._mturk_filtered_key == key:
+            return
 
         valid_results = pd.concat(
             [
                 self.get_mturk_results(hit_id, self.questions)
                 for hit_id in self.HITlist
-            ]
+            ],
+            ignore_index=True,
+            copy=False
         )
 
-        # if conditions provided, apply them
-        if len(self.conditions) > 0:
-            results = []
-            for cond in self.conditions:
-
-                try:
-                    operator = self.cond_mapping[cond['operator']]
-                except IndexError as e:
-                    raise IndexError("Condition is not supported!", e)
-
-                result = operator(valid_results, cond['variable'], cond['value'])
-                results.append(result)
+        # if conditions provided, AND their masks into one and index once
+        if len(self._parsed_conditions) > 0:
+            keep = np.ones(len(valid_results), dtype=bool)
+            for variable, operator, value, op_fn in self._parsed_conditions:
+                keep &= op_fn(valid_results, variable, value)
 
-            self.filtered_mturk_resp = recurse(results)
+            self.filtered_mturk_resp = valid_results[keep]
 
         # otherwise, just fetch all the valid results
         else:
             self.filtered_mturk_resp = valid_results.copy()
 
-        self.allAssignments = [str(i) for i in list(valid_results['AssignmentID'])]
-        self.allUsers = [str(i) for i in list(valid_results['WorkerID'])]
+        self.allAssignments = self._to_str_list(valid_results['AssignmentID'])
+        self.allUsers = self._to_str_list(valid_results['WorkerID'])
 
-        self.filteredAssignments = [
-            str(i) for i in list(self.filtered_mturk_resp['AssignmentID'])]
-        self.filteredUsers = [
-            str(i) for i in list(self.filtered_mturk_resp['WorkerID'])]
+        self.filteredAssignments = self._to_str_list(
+            self.filtered_mturk_resp['AssignmentID'])
+        self.filteredUsers = self._to_str_list(
+            self.filtered_mturk_resp['WorkerID'])
+
+        self._mturk_filtered_key = key
+
+    @staticmethod
+    def _to_str_list(column):
+        """
+        Return a column's values as a list of strings.
+
+        IDs coming from boto are already strings, so object columns are
+        listed as-is; anything else is converted with a vectorized astype.
+        """
+        if column.dtype == object:
+            return column.tolist()
+        return column.astype(str).tolist()
 
     def return_all_users(self):
         """Return all the users that have completed the screener questions."""
@@ -229,15 +376,25 @@ class Survey(object):
         Send a reminder email to a user.
         Appends the WorkerID to the end of the email
 
+        Emails are sent concurrently, up to self.MAX_NOTIFY_WORKERS at a time.
+
         :param users: list of users to receive an email
         :param subj:  the subject line of the email
         :param msg:   the body of the message
         :return:      list of users and whether they were notified
         """
+        msgs = [msg + user for user in users]
+
+        with ThreadPoolExecutor(max_workers=self.MAX_NOTIFY_WORKERS) as executor:
+            futures = [
+                executor.submit(self.mturk.notify_workers, user, subj, body)
+                for user, body in zip(users, msgs)
+            ]
+
         result = []
-        for user in users:
+        for user, future in zip(users, futures):
             try:
-                notify = self.mturk.notify_workers(user, subj, msg + user)
+                notify = future.result()
                 result.append([user, notify])
             except:
                 result.append('Could not email user: %s' % user)
@@ -251,24 +408,8 @@ class Survey(object):
         Will be sent to all users who have been filtered.
         """
         subject = "Please take second part of Survey for bonus"
-        message = """Hello,
-
-        Based on your responses to the screening question,
-        you've been selected to participate in the second
-        part of the survey.
-
-        Please go to """ + self.srvy_link + """ to complete additional
-        questions. At the end of the survey, you will be prompted
-        to enter a payment code to verify that you were selected
-        to fill out the survey. When asked, please enter the code
-        below. Upon completion, you will be awarded a bonus.
-
-        Thanks for your participation!
-
-        Sincerely,
-        """ + self.from_name + """
-
-        ### Your reward code is: """
+        message = self._FIRST_MAILER.format(srvy_link=self.srvy_link,
+                                            from_name=self.from_name)
 
         return self.send_reminder_emails(self.filteredUsers, subject, message)
 
@@ -280,29 +421,8 @@ class Survey(object):
         part two of the Survey OR who have incorrectly entered their WorkerID.
         """
         subject = "[Reminder] Bonus for participating in second part of Survey"
-        message = """Hello,
-
-        We sent you an email recently about completing additional
-        questions for the Mturk Survey. We'd really appreciate
-        your time in helping us improve our products further.
-
-        As a reminder, please go to """ + self.srvy_link + """ to complete
-        additional questions. At the end of the Survey, you will
-        be prompted to enter a payment code to verify that you were
-        selected to fill out the survey. When asked, please enter the
-        code below. Upon completion, you will be awarded a bonus.
-
-        NOTE: If you are receiving this email, but have already completed
-        the Survey, you may have entered the Survey code incorrectly.
-        Please redo the survey, ensuring that the code matches the above,
-        to receive your compensation.
-
-        Thanks for your participation!
-
-        Sincerely,
-        """ + self.from_name + """
-
-        ### Your reward code is: """
+        message = self._SECOND_MAILER.format(srvy_link=self.srvy_link,
+                                             from_name=self.from_name)
 
         return self.send_reminder_emails(self.remaining, subject, message)
 
@@ -310,6 +430,9 @@ class Survey(object):
         """
         Award a bonus amount to users who completed part 2 of the Survey.
 
+        Always re-pulls the MTurk and survey results (see self.refresh), so
+        workers who completed part 2 since the last fetch are paid too.
+
         :param amount:      a dollar amount expressed as a float
         :param customList:  [optional] a custom list of Worker IDs to send bonuses to. Will
                             override existing completed list and ONLY send to the
@@ -320,6 +443,7 @@ class Survey(object):
 
         :return:            None
         """
+        self.refresh()
         self.filter_mturk_results()
         self.get_results()
 
@@ -331,25 +455,22 @@ class Survey(object):
         else:
             workerList = self.completeActual
 
-        budget = 0
-        for hit in self.HITlist:
-
-            currentPanda = self.filtered_mturk_resp[
-                (self.filtered_mturk_resp['HITID'] == hit)
-                & (self.filtered_mturk_resp['WorkerID'].isin(workerList))]
-            pandaDict = currentPanda.set_index('WorkerID') \
-                                    .to_dict(orient='index')
+        # one bonus per worker per HIT, selected in a single pass
+        bonusPanda = self.filtered_mturk_resp.loc[
+            self.filtered_mturk_resp['WorkerID'].isin(set(workerList)),
+            ['HITID', 'WorkerID', 'AssignmentID']
+        ].drop_duplicates(['HITID', 'WorkerID'], keep='last')
 
-            for user in pandaDict:
+        budget = amount * len(bonusPanda)  # total budget required
+        for row in bonusPanda.itertuples(index=False):
 
-                budget += amount  # keeps track of the total budget required
-                if 'debug' in kwargs and kwargs['debug']:
-                    print('DEBUG ON:', user, amount)
-                else:
-                    bonus = self.mturk.grant_bonus(
-                        user, pandaDict[user]['AssignmentID'],
-                        payment, bonus_message)
-                    print(user, bonus)
+            if 'debug' in kwargs and kwargs['debug']:
+                print('DEBUG ON:', row.WorkerID, amount)
+            else:
+                bonus = self.mturk.grant_bonus(
+                    row.WorkerID, row.AssignmentID,
+                    payment, bonus_message)
+                print(row.WorkerID, bonus)
 
         if 'debug' in kwargs and kwargs['debug']:
             budget *= 1.2
@@ -369,13 +490,16 @@ class Survey(object):
         # merge the mturk responses with the gspread responses
         self.filter_mturk_results()
         self.get_results()
-        self.merged = pd.merge(self.filtered_mturk_resp,
-                               self.results,
-                               left_on='WorkerID',
-                               right_on=self.srvy_q_text)
 
-        # merge drop the joinder column since it's duplicative
-        self.merged = self.merged.drop([self.srvy_q_text], axis=1)
+        # keep each worker's latest gspread response so the join can't fan
+        # out; indexing on the joinder column also drops it from the output
+        responses = self.results.drop_duplicates(self.srvy_q_text, keep='last') \
+                                .set_index(self.srvy_q_text)
+        self.merged = self.filtered_mturk_resp.join(responses,
+                                                    on='WorkerID',
+                                                    how='inner',
+                                                    lsuffix='_x',
+                                                    rsuffix='_y')
 
         # set new index in place
         self.merged.set_index('WorkerID', inplace=True)
@@ -428,12 +552,20 @@ class GoogleForms(Survey):
         """
         Fetch results from a specified spreadsheet on Google Sheets
 
+        Results are cached per tab and column range; use self.refresh to
+        re-pull them from Google Sheets.
+
         :param spreadsheet_tab_name: the name of the tab on the Gspread sheet
                                      defaults to `Form Responses 1` since that's
                                      what Google Forms auto-generates
         :param columns: the columns to be grabbed in A1 format; defaults to `A:AZ`
         :return: pandas dataframe containing the spreadsheet data
         """
+        # completeActual / remaining depend on the filtered MTurk users too
+        key = (spreadsheet_tab_name, columns, self._mturk_filtered_key)
+        if self._results_key == key:
+            return self.results
+
         SPREADSHEET_ID = self.spreadsheet_id
         RANGE_NAME = '%s!%s' % (spreadsheet_tab_name, columns)
         result = self.service.spreadsheets().values().get(
@@ -444,24 +576,22 @@ class GoogleForms(Survey):
             print('No data found.')
         else:
 
-            # organize data into pandas df
-            df = pd.DataFrame(values)
-            df.columns = df.iloc[0]
-            df = df.reindex(df.index.drop(0))
+            # organize data into pandas df; the Sheets API trims empty
+            # trailing cells, so pad the header and every response out to
+            # the widest row (unlabelled columns get a None header)
+            width = max(map(len, values))
+            header = values[0] + [None] * (width - len(values[0]))
+            df = pd.DataFrame(
+                [row + [None] * (width - len(row)) for row in values[1:]],
+                columns=header)
 
             # grab desired data
-            self.completeList = df[self.srvy_q_text].values.tolist()
-            self.completeActual = list(
-                set([
-                    user for user in self.filteredUsers
-                    if user in self.completeList
-                    ])
-                )
-            self.remaining = [
-                user for user in self.filteredUsers
-                if user not in self.completeActual
-            ]
+            complete_set = set(df[self.srvy_q_text])
+            filtered_set = set(self.filteredUsers)
+            self.completeActual = list(filtered_set & complete_set)
+            self.remaining = list(filtered_set - complete_set)
             self.results = pd.DataFrame(df)
+            self._results_key = key
 
             return self.results
 